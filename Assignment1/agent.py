@@ -1,8 +1,139 @@
-from keras.models import Sequential
-from keras.layers import Dense
+from __future__ import annotations
+
+import h5py
 import numpy as np
-import nptyping as npt
-from typing import List, Optional
+from numba import njit, prange
+from typing import List, Optional, Tuple
+
+
+@njit(cache=True)
+def _dis_reward(agent_row: int, agent_column: int, targets: np.ndarray) -> float:
+    """
+    Computes the distance reward (the inverse manhattan distance to the closest target) for the given agent position.
+
+    Args:
+        agent_row (int): The row of the agent.
+        agent_column (int): The column of the agent.
+        targets (np.ndarray of shape (3, 2)): The positions (row, column) of the targets.
+
+    Returns:
+        float: The distance reward.
+    """
+    best = 0.0
+    for k in range(targets.shape[0]):
+        dis = abs(agent_row - targets[k, 0]) + abs(agent_column - targets[k, 1])
+
+        # If the agent is on a target, skip it
+        # This is so the reward is 0 from the distance but the agent still gets the bonus reward
+        if dis > 0:
+            best = max(best, 1.0 / dis)
+    return best
+
+
+@njit(cache=True, boundscheck=False, fastmath=True)
+def _forward_6_200_100_4(
+    observation: np.ndarray,
+    W1: np.ndarray,
+    s1: np.ndarray,
+    b1: np.ndarray,
+    W2: np.ndarray,
+    s2: np.ndarray,
+    b2: np.ndarray,
+    W3: np.ndarray,
+    s3: np.ndarray,
+    b3: np.ndarray,
+    hidden1: np.ndarray,
+    hidden2: np.ndarray,
+    values: np.ndarray,
+) -> int:
+    """
+    Computes the forward pass of the DQN (two ReLU layers followed by a linear output layer) for one observation
+    and returns the action with the highest value. The layer sizes are hard-coded so that the compiler can unroll
+    and vectorize the loops; the caller is responsible for passing arrays of exactly these shapes.
+
+    Each layer computes (x @ W) * s + b, where s is the scale of the (possibly quantized) weights of each unit. The
+    input is looped over in the outer loop, so that the weight matrices are read row by row.
+
+    Args:
+        observation (np.ndarray of shape (6,)): The observation of the current state of the environment.
+        W1, s1, b1: The weights (6, 200), scales (200,) and biases (200,) of the first hidden layer.
+        W2, s2, b2: The weights (200, 100), scales (100,) and biases (100,) of the second hidden layer.
+        W3, s3, b3: The weights (100, 4), scales (4,) and biases (4,) of the output layer.
+        hidden1, hidden2, values: Preallocated buffers of shapes (200,), (100,) and (4,) for the outputs of the
+            three layers.
+
+    Returns:
+        int: The action with the highest value (0 for 'north', 1 for 'east', 2 for 'south', 3 for 'west').
+    """
+    # First hidden layer (ReLU)
+    for j in range(200):
+        hidden1[j] = 0.0
+    for i in range(6):
+        x_i = observation[i]
+        for j in range(200):
+            hidden1[j] += x_i * W1[i, j]
+    for j in range(200):
+        hidden1[j] = max(hidden1[j] * s1[j] + b1[j], 0.0)
+
+    # Second hidden layer (ReLU)
+    for j in range(100):
+        hidden2[j] = 0.0
+    for i in range(200):
+        x_i = hidden1[i]
+        for j in range(100):
+            hidden2[j] += x_i * W2[i, j]
+    for j in range(100):
+        hidden2[j] = max(hidden2[j] * s2[j] + b2[j], 0.0)
+
+    # Output layer (linear)
+    for j in range(4):
+        values[j] = 0.0
+    for i in range(100):
+        x_i = hidden2[i]
+        for j in range(4):
+            values[j] += x_i * W3[i, j]
+    for j in range(4):
+        values[j] = values[j] * s3[j] + b3[j]
+
+    # Return the first action with the highest value
+    best = 0
+    for j in range(1, 4):
+        if values[j] > values[best]:
+            best = j
+    return best
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _forward_batch(
+    observations: np.ndarray,
+    W1: np.ndarray,
+    s1: np.ndarray,
+    b1: np.ndarray,
+    W2: np.ndarray,
+    s2: np.ndarray,
+    b2: np.ndarray,
+    W3: np.ndarray,
+    s3: np.ndarray,
+    b3: np.ndarray,
+) -> np.ndarray:
+    """
+    Computes the forward pass of the DQN for a batch of observations in parallel.
+
+    Args:
+        observations (np.ndarray of shape (N, 6)): The observations, one per row.
+        W1, s1, b1, W2, s2, b2, W3, s3, b3: The weights, scales and biases of the layers, as in _forward_6_200_100_4.
+
+    Returns:
+        np.ndarray of shape (N,): The action with the highest value for each observation.
+    """
+    actions = np.empty(observations.shape[0], dtype=np.int64)
+    for k in prange(observations.shape[0]):
+        # Every iteration gets its own buffers, as they may run in different threads
+        hidden1 = np.empty(b1.shape[0], dtype=np.float32)
+        hidden2 = np.empty(b2.shape[0], dtype=np.float32)
+        values = np.empty(b3.shape[0], dtype=np.float32)
+        actions[k] = _forward_6_200_100_4(observations[k], W1, s1, b1, W2, s2, b2, W3, s3, b3, hidden1, hidden2, values)
+    return actions
 
 
 class Agent:
@@ -13,25 +144,36 @@ class Agent:
     Attributes:
         grid_size (int): The size of the grid.
         agent_position (List[int, int]): The current position of the agent.
-        target_positions (List[List[int, int]]): The positions of the targets.
-        model (Sequential): The neural network model used to predict actions.
-        map (npt.NDArray[npt.Shape["grid_size, grid_size", int]]): A numpy array
+        target_positions (np.ndarray of shape (3, 2)): The positions (row, column) of the targets.
+        map (np.ndarray of shape (grid_size, grid_size)): A numpy array
             representing the map with the location of the targets and the agent.
         total_collected (int): The total number of targets collected.
         previously_collected (int): The index of the last target collected.
     """
 
+    # The number of units of each layer of the neural network, starting with the input dimension.
+    _LAYER_SIZES: List[int] = [6, 200, 100, 4]
+
+    # The (row, column) displacement of each action (0 for 'north', 1 for 'east', 2 for 'south', 3 for 'west').
+    _DELTAS: np.ndarray = np.array([(-1, 0), (0, 1), (1, 0), (0, -1)], dtype=np.int32)
+
     def __init__(
         self,
         grid_size: int = 10,
         weights: Optional[str] = None,
         seed: int = 1805,
+        quantize: bool = False,
+        render: bool = True,
     ) -> None:
         """
         Initializes the Agent object with default or provided values.
 
         Args:
             grid_size (int): The size of the grid. Default is 10.
+            quantize (bool): Whether to quantize the network weights to int8 (with a scale
+                per output unit) after loading them. Default is False.
+            render (bool): Whether to keep the map up to date at every move. If False, the map
+                is only redrawn when it is printed. Default is True.
         """
         super(Agent, self).__init__()
 
@@ -39,6 +181,11 @@ class Agent:
         np.random.seed(seed)
 
         self.grid_size: int = grid_size
+        self._render_enabled: bool = render
+
+        # Pool of pre-generated random positions consumed by random_state, refilled when exhausted.
+        self._rand_pool: np.ndarray = np.random.randint(0, self.grid_size, size=(4096, 2), dtype=np.int32)
+        self._rand_idx: int = 0
 
         # The sprites used to represent the agent, targets and empty cells.
         self.sprites = {
@@ -47,22 +194,42 @@ class Agent:
             "target": 2,
         }
 
+        # The characters used to print the sprites, indexed by the sprites' values on the map.
+        self._sprite_chars = np.array([".", "R", "$"])
+
         # Initialize the agent's position and the targets' positions.s
         self.agent_position: List[int] = []
-        self.target_positions: List[List[int]] = []
+        self.target_positions: np.ndarray = np.zeros((3, 2), dtype=np.int32)
+
+        # The offsets of the targets from the agent (the state), which are updated incrementally as the agent moves.
+        self._state: np.ndarray = np.zeros((3, 2), dtype=np.int32)
 
-        # Initialize the neural network model.
-        self.model = Sequential()
-        self.model.add(Dense(units=200, activation="relu", input_dim=6))
-        self.model.add(Dense(units=100, activation="relu"))
-        self.model.add(Dense(units=4, activation="linear"))
+        # Initialize the weights of the neural network (6 -> 200 -> 100 -> 4), either from the given Keras
+        # checkpoint or, as Keras does for new Dense layers, with Glorot uniform weights and zero biases.
         if weights is not None:
-            self.model.load_weights(weights)
+            layers = self._load_weights(weights)
+        else:
+            layers = self._init_weights(Agent._LAYER_SIZES, seed)
+
+        # The forward pass is specialized for these layer sizes, so check them once here
+        shapes = [(kernel.shape, bias.shape) for kernel, bias in layers]
+        expected = [((n_in, n_out), (n_out,)) for n_in, n_out in zip(Agent._LAYER_SIZES[:-1], Agent._LAYER_SIZES[1:])]
+        if shapes != expected:
+            raise ValueError(f"Expected layers of shapes {expected}, but the weights have shapes {shapes}.")
+        [(self._W1, self._b1), (self._W2, self._b2), (self._W3, self._b3)] = layers
+
+        # Per output unit scales of the weights, which are all 1 unless the weights are quantized.
+        self._s1, self._s2, self._s3 = [np.ones(b.shape, dtype=np.float32) for b in [self._b1, self._b2, self._b3]]
+        if quantize:
+            self._W1, self._s1 = self._quantize(self._W1)
+            self._W2, self._s2 = self._quantize(self._W2)
+            self._W3, self._s3 = self._quantize(self._W3)
+
+        # Buffers for the outputs of the layers, reused by every call to get_action.
+        self._scratch = tuple(np.empty(b.shape, dtype=np.float32) for b in [self._b1, self._b2, self._b3])
 
         # Initialize the map and reset it to populate it with the agent and targets.
-        self.map: npt.NDArray[
-            npt.Shape["grid_size, grid_size", int], np.dtype[np.int32]
-        ]
+        self.map: np.ndarray = np.zeros((self.grid_size, self.grid_size), dtype=np.int8)
         self.reset_map()
 
         # Initialize the total number of targets collected and the index of the last for bookkeeping.
@@ -87,61 +254,162 @@ class Agent:
             self.agent_position = self.random_state()
         if target_pos is None:  # Create 3 distinct random targets
             for i in range(3):
-                self.target_positions.append(self.random_state(self.target_positions + [self.agent_position]))
+                self.target_positions[i] = self.random_state(
+                    np.vstack([self.target_positions[:i], [self.agent_position]])
+                )
+        self._state[:] = self.target_positions - np.asarray(self.agent_position)
+
+        if self._render_enabled:
+            self._draw_map()
 
-        self.map = np.zeros((self.grid_size, self.grid_size))
+    def _draw_map(self) -> None:
+        """
+        Redraws the map from scratch with the current positions of the agent and the targets.
+        """
+        self.map = np.zeros((self.grid_size, self.grid_size), dtype=np.int8)
 
         for target in self.target_positions:
             self.map[target[0], target[1]] = self.sprites["target"]
 
         self.map[self.agent_position[0], self.agent_position[1]] = self.sprites["robot"]
 
-    def get_action(self, observation: npt.NDArray[npt.Shape["1, 6"], npt.Int]) -> int:
+    def get_action(self, observation: np.ndarray) -> int:
         """
         Returns the action predicted by the model based on the observation.
 
         Args:
-            observation (npt.NDArray[npt.Shape["1, 6"], npt.Int]): The observation of the
+            observation (np.ndarray of shape (1, 6)): The observation of the
                 current state of the environment.
 
         Returns:
             int: The predicted action (0 for 'north', 1 for 'east', 2 for 'south', 3 for 'west').
         """
-
         # index 0 because we only have 1 observation
-        predicted_class: npt.NDArray[npt.Shape["1, 4"], npt.Float] = self.model.predict(
-            observation, verbose=0
-        )[0]
-        # return the action with the highest value
-        return int(np.argmax(predicted_class))
+        return int(
+            _forward_6_200_100_4(
+                observation[0],
+                self._W1, self._s1, self._b1,
+                self._W2, self._s2, self._b2,
+                self._W3, self._s3, self._b3,
+                *self._scratch,
+            )
+        )
 
-    def random_state(self, exclude: List[List[int]] = []) -> List[int]:
+    def get_actions(self, observations: np.ndarray) -> np.ndarray:
         """
-        Generates a random state on the grid not in the "exclude" list.
+        Returns the actions predicted by the model for a batch of observations (e.g. from parallel environments).
 
         Args:
-            exclude (List[List[int]]): A list of positions (row, column) that must be selected.
+            observations (np.ndarray of shape (N, 6)): The observations, one per row.
 
         Returns:
-            List[int, int]: A randomly generated state on the grid.
+            np.ndarray of shape (N,): The predicted action for each observation (0 for 'north', 1 for
+                'east', 2 for 'south', 3 for 'west').
         """
-        state = list(np.random.randint(0, self.grid_size, 2))
-        while state in exclude:
-            state = list(np.random.randint(0, self.grid_size, 2))
-        return state
+        return _forward_batch(
+            np.ascontiguousarray(observations).reshape(-1, 6),
+            self._W1, self._s1, self._b1,
+            self._W2, self._s2, self._b2,
+            self._W3, self._s3, self._b3,
+        )
 
-    def get_state(self) -> npt.NDArray[npt.Shape["1, 6"], npt.Int]:
+    @staticmethod
+    def _load_weights(path: str) -> List[Tuple[np.ndarray, np.ndarray]]:
         """
-        Gets the current state (manhattan distance between agent and the targets) of the grid.
+        Loads the weights of the dense layers from a Keras HDF5 checkpoint (saved with either save or save_weights).
+
+        Args:
+            path (str): The path to the checkpoint.
+
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray]]: The weight matrix of shape (n_in, n_out) and the bias of shape
+                (n_out,) of each layer, in order.
+        """
+        layers = []
+        with h5py.File(path, "r") as f:
+            group = f["model_weights"] if "model_weights" in f else f
+            for layer_name in group.attrs["layer_names"]:
+                layer = group[layer_name]
+                [kernel, bias] = [
+                    np.ascontiguousarray(layer[name][()], dtype=np.float32) for name in layer.attrs["weight_names"]
+                ]
+                layers.append((kernel, bias))
+        return layers
+
+    @staticmethod
+    def _init_weights(sizes: List[int], seed: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Initializes the weights of the dense layers with Glorot uniform weight matrices and zero biases.
+
+        Args:
+            sizes (List[int]): The number of units of each layer, starting with the input dimension.
+            seed (int): The seed of the random generator (separate from the global one used for the grid).
+
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray]]: The weight matrix of shape (n_in, n_out) and the bias of shape
+                (n_out,) of each layer, in order.
+        """
+        rng = np.random.default_rng(seed)
+        layers = []
+        for fan_in, fan_out in zip(sizes[:-1], sizes[1:]):
+            limit = np.sqrt(6.0 / (fan_in + fan_out))
+            kernel = rng.uniform(-limit, limit, size=(fan_in, fan_out)).astype(np.float32)
+            layers.append((kernel, np.zeros(fan_out, dtype=np.float32)))
+        return layers
+
+    @staticmethod
+    def _quantize(weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Quantizes the weight matrix of a dense layer to int8 with a symmetric scale per column (output unit).
+
+        Args:
+            weights (np.ndarray of shape (n_in, n_out)): The weight matrix of the layer.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The int8 quantized weights of shape (n_in, n_out) and the scales of shape
+                (n_out,) such that weights ~= quantized * scales.
+        """
+        scales = np.abs(weights).max(axis=0) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.round(weights / scales).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    def random_state(self, exclude: np.ndarray = np.empty((0, 2))) -> List[int]:
+        """
+        Generates a random state on the grid not in the "exclude" array.
+
+        Args:
+            exclude (np.ndarray of shape (N, 2)): An array of positions (row, column) that must not be
+                selected.
 
         Returns:
-            npt.NDArray[npt.Shape["1, 6"], npt.Int]: The current state of the grid.
+            List[int, int]: A randomly generated state on the grid.
         """
-        # Convert to numpy array for easier calculations
-        target_locations = np.array(self.target_positions)
-        agent_location = np.array(self.agent_position)
+        exclude = np.asarray(exclude).reshape(-1, 2)
+
+        # Take a batch of candidates from the pool at once and pick the first one that is not excluded
+        while True:
+            if self._rand_idx + 16 > len(self._rand_pool):
+                self._rand_pool = np.random.randint(0, self.grid_size, size=self._rand_pool.shape, dtype=np.int32)
+                self._rand_idx = 0
+            candidates = self._rand_pool[self._rand_idx : self._rand_idx + 16]
+            excluded = (candidates[:, None, :] == exclude[None, :, :]).all(axis=-1).any(axis=-1)
+            if not excluded.all():
+                # Only consume the candidates up to (and including) the selected one
+                k = int(np.argmin(excluded))
+                self._rand_idx += k + 1
+                return list(candidates[k])
+            self._rand_idx += len(candidates)
+
+    def get_state(self) -> np.ndarray:
+        """
+        Gets the current state (manhattan distance between agent and the targets) of the grid.
 
-        return (target_locations - agent_location).reshape(1, 6)
+        Returns:
+            np.ndarray of shape (1, 6): The current state of the grid. This is a view that is updated
+                in place when the agent moves, copy it to keep the state of a specific timestep.
+        """
+        return self._state.reshape(1, 6)
 
     def move(self, a: int) -> float:
         """
@@ -157,7 +425,8 @@ class Agent:
         [row, column] = self.agent_position
 
         # Remove the agent from the current position (to move elsewhere)
-        self.map[row, column] = self.sprites["empty"]
+        if self._render_enabled:
+            self.map[row, column] = self.sprites["empty"]
 
         bonusReward: int = 100
 
@@ -166,56 +435,60 @@ class Agent:
 
         # If the agent has collected a target, remove it from the map
         if len(self.previously_collected) != 0:
-            self.map[self.previously_collected[0]][
-                self.previously_collected[1]
-            ] = self.sprites["empty"]
+            if self._render_enabled:
+                self.map[self.previously_collected[0]][
+                    self.previously_collected[1]
+                ] = self.sprites["empty"]
             self.previously_collected = []
 
         # Move the agent in the given direction
-        if a == 0:  # north
-            row = row - 1
-        elif a == 1:  # east
-            column = column + 1
-        elif a == 2:  # south
-            row = row + 1
-        elif a == 3:  # west
-            column = column - 1
+        [d_row, d_column] = Agent._DELTAS[a]
+        row = row + d_row
+        column = column + d_column
 
         agent_reward: float = 0.0
 
-        # Penalty for going out of bounds
-        if row < 0 or row >= self.grid_size or column < 0 or column >= self.grid_size:
+        # Penalty for going out of bounds (row | column is negative iff either of them is)
+        if (row | column) < 0 or row >= self.grid_size or column >= self.grid_size:
             [row, column] = self.agent_position  # Reset to previous position
             agent_reward = -10
+        else:
+            # The agent moved, so all the targets moved by the opposite displacement relative to the agent
+            self._state -= Agent._DELTAS[a]
 
         # Get the new distance reward
         dis_reward = self._get_dis_reward([row, column])
 
-        # Check if the agent has collected a target
-        for i in range(len(self.target_positions)):
-            if self.target_positions[i] == [row, column]:
-                # Reward the agent for collecting a target
-                agent_reward = bonusReward
+        # Check if the agent has collected a target (the targets are distinct, so at most one can be hit)
+        hit = np.where((self.target_positions[:, 0] == row) & (self.target_positions[:, 1] == column))[0]
+        if hit.size:
+            i = hit[0]
+
+            # Reward the agent for collecting a target
+            agent_reward = bonusReward
 
-                # Store the position of the target that was collected
-                self.previously_collected = self.target_positions[i]
+            # Store the position of the target that was collected
+            self.previously_collected = self.target_positions[i].tolist()
 
-                # Generate a new target (blocking the position of the current target positions)
-                self.target_positions[i] = self.random_state(self.target_positions)
-                [g1, g2] = self.target_positions[i]
+            # Generate a new target (blocking the position of the current target positions)
+            self.target_positions[i] = self.random_state(self.target_positions)
+            [g1, g2] = self.target_positions[i]
+            self._state[i] = [g1 - row, g2 - column]
 
-                # Update the map
+            # Update the map
+            if self._render_enabled:
                 self.map[g1][g2] = self.sprites["target"]
 
-                # Update the total number of targets collected
-                self.total_collected += 1
+            # Update the total number of targets collected
+            self.total_collected += 1
 
         # If the agent has collected a target or received no penalty, add the distance reward
         if agent_reward >= 0:
             agent_reward += dis_reward - prev_dis_reward
 
         # Update the position of the agent on the map
-        self.map[row][column] = self.sprites["robot"]
+        if self._render_enabled:
+            self.map[row][column] = self.sprites["robot"]
         self.agent_position = [row, column]
         return agent_reward
 
@@ -231,56 +504,34 @@ class Agent:
             float: The distance reward.
         """
         if agent_pos is None:
-            agent_pos = np.array(self.agent_position)
-        else:
-            agent_pos = np.array(agent_pos)
+            agent_pos = self.agent_position
 
-        target_pos = np.array(self.target_positions)
-
-        # Calculate the manhattan distance between the agent and the targets
-        dis = np.abs(agent_pos[0] - target_pos[:, 0]) + np.abs(
-            agent_pos[1] - target_pos[:, 1]
-        )
-
-        # If the agent is on a target, set the distance to a large number
-        # This is so the reward is 0 from the distance but the agent still gets the bonus reward
-        dis[dis == 0] = 10**9
-        return float(np.max(1.0 / dis))
+        return _dis_reward(int(agent_pos[0]), int(agent_pos[1]), self.target_positions)
 
     def print_map(self):
         """
         Print the current state of the game map.
 
-        The function loops through the rows and columns of the game map, and prints a character representing each sprite type
-        in the corresponding cell. An empty space is represented by a period (.), the robot is represented by a capital letter R,
-        and the target is represented by a dollar sign ($).
+        The function looks up the character representing the sprite type of every cell of the game map, and prints the
+        resulting rows at once. An empty space is represented by a period (.), the robot is represented by a capital letter
+        R, and the target is represented by a dollar sign ($).
 
         Example usage:
             agent.print_map()
 
         :return: None
         """
-        output_string = ""
-
-        print("--------------------")
-        output_string += "--------------------\n"
-        for row in range(0, self.map.shape[0]):
-            for col in range(0, self.map.shape[1]):
-                if self.map[row, col] == self.sprites["empty"]:  # Empty space
-                    print(".", end="")
-                    output_string += "."
-                if self.map[row, col] == self.sprites["robot"]:  # The agent/robot
-                    print("R", end="")
-                    output_string += "R"
-                if self.map[row, col] == self.sprites["target"]:  # Target
-                    print("$", end="")
-                    output_string += "$"
-            print()
-            output_string += "\n"
-        print("--------------------")
-        output_string += "--------------------\n"
+        # The map is not kept up to date when rendering is disabled, so draw it now
+        if not self._render_enabled:
+            self._draw_map()
+
+        chars = self._sprite_chars[self.map]
+        rows = ["".join(row) for row in chars]
+        output_string = "\n".join(["--------------------"] + rows + ["--------------------"])
+
+        print(output_string)
         with open("output.txt", "a") as f:
-            f.write(output_string)
+            f.write(output_string + "\n")
 
     @staticmethod
     def clear_lines(n_lines: Optional[int] = 12) -> None:
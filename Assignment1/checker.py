@@ -1,44 +1,90 @@
+import hashlib
+import shelve
 from typing import Dict, List, Optional, Tuple
 
-from z3 import And, Or, Bool, CheckSatResult, If, Int, Not, Solver
-
-
-def init_environment(timesteps: int, grid_size: Optional[int] = 10) -> Tuple[
+import numpy as np
+from z3 import (
+    And,
+    Or,
+    Bool,
+    BitVec,
+    BoolRef,
+    CheckSatResult,
+    Implies,
+    Not,
+    Solver,
+    Tactic,
+    UGE,
+    ULE,
+    ZeroExt,
+    parse_smt2_string,
+    sat,
+    unknown,
+    unsat,
+)
+
+# The number of bits of the (unsigned) bit-vectors encoding the positions, which supports grids of up to 255 cells wide
+POSITION_BITS = 8
+
+# The number of bits of the (signed) bit-vectors encoding the distances: one more than the positions for the sign, and
+# one more again so that closest_target can add the distances along both axes without wrapping around
+DISTANCE_BITS = POSITION_BITS + 2
+
+# The solver and the variables of the environment, as returned by init_environment
+Environment = Tuple[
     Solver,
-    Dict[str, List[Int]],
-    Dict[int, Dict[str, List[Int]]],
-    Dict[int, Dict[str, List[Int]]],
+    Dict[str, List[BitVec]],
+    Dict[int, Dict[str, List[BitVec]]],
+    Optional[Dict[int, Dict[str, List[BitVec]]]],
     Dict[str, List[Bool]],
-]:
+]
+
+
+def init_environment(
+    timesteps: int,
+    grid_size: Optional[int] = 10,
+    need_distance: bool = False,
+) -> Environment:
     """
     Initializes the Z3 variables and constraints for the environment.
 
     Args:
         timesteps (int): The number of timesteps in the planning horizon.
         grid_size (int, optional): The size of the grid. Defaults to 10.
+        need_distance (bool, optional): Whether to create the distance variables. Defaults to False.
 
     Returns:
         Tuple[
             Solver,
-            Dict[str, List[Int]],
-            Dict[int, Dict[str, List[Int]]],
-            Dict[int, Dict[str, List[Int]]],
+            Dict[str, List[BitVec]],
+            Dict[int, Dict[str, List[BitVec]]],
+            Optional[Dict[int, Dict[str, List[BitVec]]]],
             Dict[str, List[Bool]],
         ]:
             A tuple containing the following:
                 Solver: The Z3 solver.
-                Dict[str, List[Int]]: A dictionary containing the agent's position (row, column) at each timestep.
-                Dict[int, Dict[str, List[Int]]]: A dictionary containing the targets' position (row, column) at each timestep.
-                Dict[int, Dict[str, List[Int]]]: A dictionary containing the distances between each target and the agent at each timestep.
+                Dict[str, List[BitVec]]: A dictionary containing the agent's position (row, column) at each timestep.
+                Dict[int, Dict[str, List[BitVec]]]: A dictionary containing the targets' position (row, column) at each timestep.
+                Optional[Dict[int, Dict[str, List[BitVec]]]]: A dictionary containing the distances between each target and the agent at each timestep,
+                or None if need_distance is False.
                 Dict[str, List[Bool]]: A dictionary containing the agent's direction of movement at each timestep (0 for 'north', 1 for 'east', 2 for 'south', 3 for 'west').
     """
+    if not 0 < grid_size < 1 << POSITION_BITS:
+        raise ValueError(
+            "The grid size must be between 1 and {}, but is {}.".format(
+                (1 << POSITION_BITS) - 1, grid_size
+            )
+        )
+
     # Dictionary to store the agent position (row, column) at each timestep
-    agent_position: Dict[str, List[Int]] = {"row": [], "column": []}
+    agent_position: Dict[str, List[BitVec]] = {"row": [], "column": []}
     for axis in ["row", "column"]:
-        agent_position[axis] = [Int("a_{}{}".format(axis, t)) for t in range(timesteps)]
+        agent_position[axis] = [
+            BitVec("a_{}{}".format(axis, t), POSITION_BITS) for t in range(timesteps)
+        ]
 
     # Dictionary to store the targets' position (row, column) at each timestep
-    target_positions: Dict[int, Dict[str, List[Int]]] = {
+    target_positions: Dict[int, Dict[str, List[BitVec]]] = {
         0: {"row": [], "column": []},
         1: {"row": [], "column": []},
         2: {"row": [], "column": []},
@@ -46,20 +92,25 @@ def init_environment(timesteps: int, grid_size: Optional[int] = 10) -> Tuple[
     for target in target_positions:
         for axis in ["row", "column"]:
             target_positions[target][axis] = [
-                Int("t_{}{}{}".format(target, axis, t)) for t in range(timesteps)
+                BitVec("t_{}{}{}".format(target, axis, t), POSITION_BITS)
+                for t in range(timesteps)
             ]
 
-    # Dictionary to store each of the target distances from the agent at each timestep
-    targets_distance: Dict[int, Dict[str, List[Int]]] = {
-        0: {"row": [], "column": []},
-        1: {"row": [], "column": []},
-        2: {"row": [], "column": []},
-    }
-    for target in targets_distance:
-        for axis in ["row", "column"]:
-            targets_distance[target][axis] = [
-                Int("d_{}{}{}".format(target, axis, t)) for t in range(timesteps)
-            ]
+    # Dictionary to store each of the target distances from the agent at each timestep (signed, see DISTANCE_BITS),
+    # which is only created when asked for, as closest_target can also use the position differences directly
+    targets_distance: Optional[Dict[int, Dict[str, List[BitVec]]]] = None
+    if need_distance:
+        targets_distance = {
+            0: {"row": [], "column": []},
+            1: {"row": [], "column": []},
+            2: {"row": [], "column": []},
+        }
+        for target in targets_distance:
+            for axis in ["row", "column"]:
+                targets_distance[target][axis] = [
+                    BitVec("d_{}{}{}".format(target, axis, t), DISTANCE_BITS)
+                    for t in range(timesteps)
+                ]
 
     # Dictionary to store each action at each timestep (boolean)
     agent_direction: Dict[str, List[Bool]] = {
@@ -69,97 +120,106 @@ def init_environment(timesteps: int, grid_size: Optional[int] = 10) -> Tuple[
         "west": [Bool("west_{}".format(t)) for t in range(timesteps)],
     }
 
-    # Initialize the solver
-    solver = Solver()
+    # Initialize the solver, which bit-blasts the (quantifier-free) bit-vector constraints to SAT
+    solver = Tactic("qfbv").solver()
+
+    # The constraints are written as SMT-LIB2 text, which Z3 parses much faster than the same constraints are built
+    # through the Python API. The declared constants are the variables above, which have the same names and sorts
+    lines = []
+    for t in range(timesteps):
+        lines.extend(_position_declarations(t))
+        if targets_distance is not None:
+            for axis in ["row", "column"]:
+                for i in range(3):
+                    lines.append(
+                        "(declare-const d_{}{}{} (_ BitVec {}))".format(
+                            i, axis, t, DISTANCE_BITS
+                        )
+                    )
+        for direction in agent_direction:
+            lines.append("(declare-const {}_{} Bool)".format(direction, t))
 
     # Constraints to ensure that the agent and all the targets are within the grid at each timestep
+    # (the positions are unsigned, so they are non-negative by construction)
+    grid_end = _bv_literal(grid_size)
     for t in range(timesteps):
         for axis in ["row", "column"]:
             for i in range(3):
-                solver.add(target_positions[i][axis][t] < grid_size)
-                solver.add(target_positions[i][axis][t] >= 0)
+                lines.append(
+                    "(assert (bvult t_{}{}{} {}))".format(i, axis, t, grid_end)
+                )
 
-            solver.add(agent_position[axis][t] < grid_size)
-            solver.add(agent_position[axis][t] >= 0)
+            lines.append("(assert (bvult a_{}{} {}))".format(axis, t, grid_end))
 
-    # Constraint to ensure that if one target is picked up, a new target appears at a different location
+    # Constraint to ensure that if one target is picked up, a new target appears at a different location:
+    # if the agent was at the target's position in the previous timestep, then either the row or column position of
+    # the target must have changed since the last timestep (as an implication, there are no further constraints otherwise)
     for t in range(1, timesteps):
         for i in range(3):
-            solver.add(
-                If(  # if: the agent was at the target's position in the previous timestep
-                    And(
-                        target_positions[i]["row"][t - 1]
-                        == agent_position["row"][t - 1],
-                        target_positions[i]["column"][t - 1]
-                        == agent_position["column"][t - 1],
-                    ),
-                    # then: either the row or column position of the target must have changed since the last timestep
-                    Not(
-                        And(
-                            target_positions[i]["row"][t]
-                            != target_positions[i]["row"][t - 1],
-                            target_positions[i]["column"][t]
-                            != target_positions[i]["column"][t - 1],
-                        )
-                    ),
-                    # else: no further constraints
-                    True,
+            lines.append(
+                "(assert (=> (and (= t_{i}row{p} a_row{p}) (= t_{i}column{p} a_column{p}))"
+                " (not (and (distinct t_{i}row{t} t_{i}row{p})"
+                " (distinct t_{i}column{t} t_{i}column{p})))))".format(
+                    i=i, t=t, p=t - 1
                 )
             )
 
-    # Constraint to ensure that all the targets are in different locations at each timestep
+    # Constraint to ensure that all the targets are in different locations at each timestep, by encoding each location
+    # as a single bit-vector (the concatenation of the row and column, i.e. row * 2^POSITION_BITS + column)
     for t in range(timesteps):
-        for i in range(3):
-            for j in range(i):
-                solver.add(
-                    Not(
-                        And(
-                            target_positions[i]["row"][t]
-                            == target_positions[j]["row"][t],
-                            target_positions[i]["column"][t]
-                            == target_positions[j]["column"][t],
-                        )
-                    )
+        lines.append(
+            "(assert (distinct {}))".format(
+                " ".join(
+                    "(concat t_{i}row{t} t_{i}column{t})".format(i=i, t=t)
+                    for i in range(3)
                 )
+            )
+        )
 
     # Constraint to ensure that distance between the agent and the targets is valid at each timestep
+    if targets_distance is not None:
+        for t in range(timesteps):
+            for axis in ["row", "column"]:
+                for i in range(3):
+                    lines.append(
+                        "(assert (= d_{i}{axis}{t} (bvsub ((_ zero_extend {e}) t_{i}{axis}{t})"
+                        " ((_ zero_extend {e}) a_{axis}{t}))))".format(
+                            i=i, axis=axis, t=t, e=DISTANCE_BITS - POSITION_BITS
+                        )
+                    )
+
+    # Constraint to ensure that the agent moves in exactly one direction at each timestep
     for t in range(timesteps):
-        for axis in ["row", "column"]:
-            for i in range(3):
-                solver.add(
-                    targets_distance[i][axis][t]
-                    == target_positions[i][axis][t] - agent_position[axis][t]
-                )
+        lines.append(
+            "(assert ((_ pbeq 1 1 1 1 1) north_{t} east_{t} south_{t} west_{t}))".format(
+                t=t
+            )
+        )
 
-    # Constraint to ensure that the agent can only move in one direction at each timestep
+    # Constraint to ensure that the agent can only move in one direction at each timestep, as a linear sum of the
+    # directions (each one if the agent moved in that direction and zero otherwise; subtracting one wraps around,
+    # which the grid bounds then exclude)
+    [zero, one] = [_bv_literal(v) for v in [0, 1]]
     for t in range(1, timesteps):
-        solver.add(
-            agent_position["row"][t]  # agent's current row position
-            == agent_position["row"][
-                t - 1
-            ]  # is equal to the agent's previous row position
-            + If(
-                agent_direction["north"][t - 1],
-                -1,  # if the agent moved north, then the agent's current row position is one less than the agent's previous row position
-                If(
-                    agent_direction["south"][t - 1], 1, False
-                ),  # if the agent moved south, then the agent's current row position is one more than the agent's previous row position
+        [north, east, south, west] = [
+            "(ite {}_{} {} {})".format(direction, t - 1, one, zero)
+            for direction in ["north", "east", "south", "west"]
+        ]
+        # the agent's current row position is the previous one, one less if it moved north and one more if it moved south
+        lines.append(
+            "(assert (= a_row{} (bvadd (bvsub a_row{} {}) {})))".format(
+                t, t - 1, north, south
             )
         )
-        solver.add(
-            agent_position["column"][t]  # agent's current column position
-            == agent_position["column"][
-                t - 1
-            ]  # is equal to the agent's previous column position
-            + If(
-                agent_direction["east"][t - 1],
-                1,  # if the agent moved west, then the agent's current column position is one more than the agent's previous column position
-                If(
-                    agent_direction["west"][t - 1], -1, False
-                ),  # if the agent moved east, then the agent's current column position is one less than the agent's previous column position
+        # the agent's current column position is the previous one, one more if it moved east and one less if it moved west
+        lines.append(
+            "(assert (= a_column{} (bvsub (bvadd a_column{} {}) {})))".format(
+                t, t - 1, east, west
             )
         )
 
+    solver.add(parse_smt2_string("\n".join(lines)))
+
     return (
         solver,
         agent_position,
@@ -169,75 +229,332 @@ def init_environment(timesteps: int, grid_size: Optional[int] = 10) -> Tuple[
     )
 
 
-def check_run(
+def _bv_literal(value: int, bits: int = POSITION_BITS) -> str:
+    """
+    Returns the SMT-LIB2 literal of a bit-vector value.
+
+    Args:
+        value (int): The (non-negative) value.
+        bits (int, optional): The number of bits of the bit-vector. Defaults to POSITION_BITS.
+
+    Returns:
+        str: The literal, e.g. (_ bv3 8).
+    """
+    if not 0 <= value < 1 << bits:
+        raise ValueError(
+            "The value {} does not fit in a bit-vector of {} bits.".format(value, bits)
+        )
+    return "(_ bv{} {})".format(value, bits)
+
+
+def _position_declarations(t: int) -> List[str]:
+    """
+    Returns the SMT-LIB2 declarations of the positions of the agent and the targets at a timestep, which declare the
+    same constants as the variables of init_environment.
+
+    Args:
+        t (int): The timestep.
+
+    Returns:
+        List[str]: The declarations.
+    """
+    position_sort = "(_ BitVec {})".format(POSITION_BITS)
+    return [
+        "(declare-const {}{}{} {})".format(prefix, axis, t, position_sort)
+        for axis in ["row", "column"]
+        for prefix in ["a_", "t_0", "t_1", "t_2"]
+    ]
+
+
+def detect_picks(target_positions: np.ndarray) -> List[Tuple[int, int]]:
+    """
+    Finds the targets picked by the agent, by checking at each timestep if any of the targets' coordinates have changed.
+
+    Args:
+        target_positions (np.ndarray): The positions of the targets at each timestep, of shape (timesteps, 3, 2).
+
+    Returns:
+        List[Tuple[int, int]]: The picked targets in order, each as the index of the target and the timestep at which
+        it has been replaced.
+    """
+    changed = np.any(target_positions[1:] != target_positions[:-1], axis=2)
+    times, targets = np.nonzero(changed)
+    return list(zip(targets.tolist(), (times + 1).tolist()))
+
+
+def has_step_back(action_list: np.ndarray) -> bool:
+    """
+    Checks if the agent ever directly moved back to the previous square. A run without such a step cannot contain any
+    loops of size 2, so find_loop only needs to be asked about the runs with one.
+
+    Args:
+        action_list (np.ndarray): The actions taken by the agent, where 0 represents north, 1 represents east,
+        2 represents south, and 3 represents west.
+
+    Returns:
+        bool: Whether any action is the opposite of the one before it.
+    """
+    # The opposite directions (north and south, east and west) differ by exactly 2, which is their XOR
+    return bool(np.any(np.bitwise_xor(action_list[1:], action_list[:-1]) == 2))
+
+
+def _closer_targets(
+    agent_position_list: np.ndarray,
+    target_position_list: np.ndarray,
+    picks: List[Tuple[int, int]],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compares the picked targets with the other targets at the times of choosing them, with the distances as
+    closest_target defines them (the sum of the signed differences of the rows and the columns).
+
+    Args:
+        agent_position_list (np.ndarray): The positions of the agent at each timestep, of shape (timesteps, 2).
+        target_position_list (np.ndarray): The positions of the targets at each timestep, of shape (timesteps, 3, 2).
+        picks (List[Tuple[int, int]]): The picked targets, as returned by detect_picks.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The picked targets, the times of choosing them (the start and the
+        arrival times at all but the last picked target), and for each pick which targets were closer than the picked one.
+    """
+    chosen_targets = np.array([target for target, _ in picks], dtype=np.int64)
+    choosing_times = np.array(
+        [0] + [arr_time for _, arr_time in picks[:-1]], dtype=np.int64
+    )[: len(picks)]
+    distances = (
+        target_position_list[choosing_times].astype(np.int64)
+        - agent_position_list[choosing_times, None, :]
+    ).sum(axis=2)
+    closer = distances < distances[np.arange(len(picks)), chosen_targets, None]
+    return chosen_targets, choosing_times, closer
+
+
+def picks_closest(
+    agent_position_list: np.ndarray,
+    target_position_list: np.ndarray,
+    picks: List[Tuple[int, int]],
+) -> bool:
+    """
+    Checks directly on the run's data if the agent always went for the closest target, with the distances as
+    closest_target defines them. When it did, there is no need to ask closest_target about a run that passed
+    check_run (the data of a run that did not is rejected by every check).
+
+    Args:
+        agent_position_list (np.ndarray): The positions of the agent at each timestep, of shape (timesteps, 2).
+        target_position_list (np.ndarray): The positions of the targets at each timestep, of shape (timesteps, 3, 2).
+        picks (List[Tuple[int, int]]): The picked targets, as returned by detect_picks.
+
+    Returns:
+        bool: Whether each picked target was (one of) the closest at the time of choosing it.
+    """
+    _, _, closer = _closer_targets(agent_position_list, target_position_list, picks)
+    return not closer.any()
+
+
+def run_key(
+    agent_position_list: np.ndarray,
+    target_position_list: np.ndarray,
+    action_list: np.ndarray,
+    grid_size: int = 10,
+) -> str:
+    """
+    Hashes the data of a run, as the key of its results in the results cache.
+
+    Args:
+        agent_position_list (np.ndarray): The positions of the agent at each timestep.
+        target_position_list (np.ndarray): The positions of the targets at each timestep.
+        action_list (np.ndarray): The actions taken by the agent at each timestep.
+        grid_size (int, optional): The size of the grid. Defaults to 10.
+
+    Returns:
+        str: The (hexadecimal) BLAKE2b digest of the run's data.
+    """
+    # The data is hashed as 16-bit integers, which hold every position and action without wrapping, whatever type
+    # it was stored in
+    digest = hashlib.blake2b(str(grid_size).encode())
+    for data in [agent_position_list, target_position_list, action_list]:
+        digest.update(np.ascontiguousarray(data, dtype=np.int16).tobytes())
+    return digest.hexdigest()
+
+
+def load_results(path: str, key: str) -> Dict[str, CheckSatResult]:
+    """
+    Loads the cached results of the checks of a run.
+
+    Args:
+        path (str): The path of the results cache.
+        key (str): The key of the run, as returned by run_key.
+
+    Returns:
+        Dict[str, CheckSatResult]: The results of the checks that have been cached for the run, by name.
+    """
+    with shelve.open(path) as cache:
+        results = cache.get(key, {})
+    return {
+        name: {"sat": sat, "unsat": unsat, "unknown": unknown}[result]
+        for name, result in results.items()
+    }
+
+
+def save_results(path: str, key: str, results: Dict[str, CheckSatResult]) -> None:
+    """
+    Saves the results of the checks of a run in the results cache, along with the ones cached before.
+
+    Args:
+        path (str): The path of the results cache.
+        key (str): The key of the run, as returned by run_key.
+        results (Dict[str, CheckSatResult]): The results of the checks, by name.
+    """
+    with shelve.open(path) as cache:
+        cache[key] = {
+            **cache.get(key, {}),
+            **{name: str(result) for name, result in results.items()},
+        }
+
+
+def _distance(environment: Environment, target: int, axis: str, t: int) -> BitVec:
+    """
+    Returns the signed distance between a target and the agent along an axis at a timestep.
+
+    Args:
+        environment (Environment): The environment, as returned by init_environment.
+        target (int): The index of the target.
+        axis (str): The axis, either 'row' or 'column'.
+        t (int): The timestep.
+
+    Returns:
+        BitVec: The distance variable if the environment has one, else the equivalent position difference.
+    """
+    _, agent_position, target_positions, targets_distance, _ = environment
+    if targets_distance is not None:
+        return targets_distance[target][axis][t]
+    extension = DISTANCE_BITS - POSITION_BITS
+    return ZeroExt(extension, target_positions[target][axis][t]) - ZeroExt(
+        extension, agent_position[axis][t]
+    )
+
+
+def add_run_data(
+    environment: Environment,
     agent_position_list: List[List[int]],
     target_position_list: List[List[List[int]]],
     action_list: List[int],
-    grid_size: Optional[int] = 10,
-) -> CheckSatResult:
+) -> List[BoolRef]:
     """
-    Check if the given sequence of actions leads the agent from the given initial positions to the target positions on a grid of
-    the specified size without colliding with obstacles.
+    Adds the data of a run (the positions of the agent and the targets and the actions at each timestep) to the solver
+    of the environment. Rather than asserting the data directly, the positions at each timestep are guarded by an
+    indicator literal, and the data only holds when checking under the returned assumptions. Push a scope on the
+    solver before calling this function to be able to remove the run again with a pop.
 
     Args:
+        environment (Environment): The solver and variables of the environment, as returned by init_environment.
         agent_position_list (List[List[int]]): A list of agent positions where each position is a list of two integers
         representing the coordinates (row and column) of the agent at that time step.
         target_position_list (List[List[List[int]]]): A list of target positions where each target position is a list of
         three lists of two integers representing the coordinates (row and column) of the three targets at that time step.
         action_list (List[int]): A list of integers representing the sequence of actions taken by the agent where 0 represents
         north, 1 represents east, 2 represents south, and 3 represents west.
-        grid_size (Optional[int]): An optional integer representing the size of the square grid. Defaults to 10.
 
     Returns:
-        CheckSatResult: An enumeration indicating whether the given sequence of actions leads to a valid solution or not.
+        List[BoolRef]: The assumptions to pass to solver.check for the run's data to hold.
     """
-    # Initialize the environment
     (
         solver,
         agent_position,
         target_positions,
         _,
         agent_direction,
-    ) = init_environment(len(action_list), grid_size)
+    ) = environment
 
-    # Add the run's data as constraints to the solver
-    for t in range(len(agent_position_list)):
-        solver.add(agent_position["row"][t] == int(agent_position_list[t][0]))
-        solver.add(agent_position["column"][t] == int(agent_position_list[t][1]))
+    # The run's data may be given as arrays, which are converted to lists once, as their elements are faster to index
+    agent_position_list = np.asarray(agent_position_list).tolist()
+    target_position_list = np.asarray(target_position_list).tolist()
+    action_list = np.asarray(action_list).tolist()
 
-        for i in range(3):
-            solver.add(
-                target_positions[i]["row"][t] == int(target_position_list[t][i][0])
-            )
-            solver.add(
-                target_positions[i]["column"][t] == int(target_position_list[t][i][1])
+    # The literals of the positions and the names of the directions are built once, instead of at each comparison
+    position_values = [_bv_literal(v) for v in range(1 << POSITION_BITS)]
+    directions = ["north", "east", "south", "west"]
+
+    # As in init_environment, the constraints are written as SMT-LIB2 text
+    lines = []
+    assumptions: List[BoolRef] = []
+    for t in range(len(agent_position_list)):
+        # The positions of the agent and the targets only hold if the indicator literal of the timestep is assumed
+        lines.extend(_position_declarations(t))
+        lines.append("(declare-const run_{} Bool)".format(t))
+        lines.append(
+            "(assert (=> run_{t} (and (= a_row{t} {}) (= a_column{t} {}) {})))".format(
+                position_values[agent_position_list[t][0]],
+                position_values[agent_position_list[t][1]],
+                " ".join(
+                    "(= t_{}{}{} {})".format(
+                        i, axis, t, position_values[target_position_list[t][i][j]]
+                    )
+                    for i in range(3)
+                    for j, axis in enumerate(["row", "column"])
+                ),
+                t=t,
             )
+        )
+        assumptions.append(Bool("run_{}".format(t), solver.ctx))
+
+        # The directions are Booleans already, so the taken one can be assumed directly
+        # (the exactly-one constraint of the environment then makes the other three false)
+        assumptions.append(agent_direction[directions[action_list[t]]][t])
+
+    solver.add(parse_smt2_string("\n".join(lines), ctx=solver.ctx))
+    return assumptions
+
+
+def check_run(
+    environment: Environment,
+    assumptions: List[BoolRef],
+    agent_position_list: List[List[int]],
+    target_position_list: List[List[List[int]]],
+    action_list: List[int],
+) -> CheckSatResult:
+    """
+    Check if the given sequence of actions leads the agent from the given initial positions to the target positions on a grid of
+    the specified size without colliding with obstacles.
 
-        solver.add(agent_direction["north"][t] == bool(action_list[t] == 0))
-        solver.add(agent_direction["east"][t] == bool(action_list[t] == 1))
-        solver.add(agent_direction["south"][t] == bool(action_list[t] == 2))
-        solver.add(agent_direction["west"][t] == bool(action_list[t] == 3))
+    Args:
+        environment (Environment): The solver and variables of the environment, as returned by init_environment, with
+        the run's data added by add_run_data.
+        assumptions (List[BoolRef]): The assumptions under which the run's data holds, as returned by add_run_data.
+        agent_position_list (List[List[int]]): A list of agent positions where each position is a list of two integers
+        representing the coordinates (row and column) of the agent at that time step.
+        target_position_list (List[List[List[int]]]): A list of target positions where each target position is a list of
+        three lists of two integers representing the coordinates (row and column) of the three targets at that time step.
+        action_list (List[int]): A list of integers representing the sequence of actions taken by the agent where 0 represents
+        north, 1 represents east, 2 represents south, and 3 represents west.
 
-    return solver.check()
+    Returns:
+        CheckSatResult: An enumeration indicating whether the given sequence of actions leads to a valid solution or not.
+    """
+    # The run's data has already been added to the environment, so only check it
+    solver = environment[0]
+    return solver.check(*assumptions)
 
 
 def find_loop(
+    environment: Environment,
+    assumptions: List[BoolRef],
     agent_position_list: List[List[int]],
     target_position_list: List[List[List[int]]],
     action_list: List[int],
-    grid_size: Optional[int] = 10,
 ) -> CheckSatResult:
     """
     Checks if the path of the agent contains any loops of size 2, i.e.: the agent directly moving back to the previous square.
 
     Args:
+        environment (Environment): The solver and variables of the environment, as returned by init_environment, with
+        the run's data added by add_run_data.
+        assumptions (List[BoolRef]): The assumptions under which the run's data holds, as returned by add_run_data.
         agent_position_list (List[List[int]]): A list of agent positions where each position is a list of two integers
         representing the coordinates (row and column) of the agent at that time step.
         target_position_list (List[List[List[int]]]): A list of target positions where each target position is a list of
         three lists of two integers representing the coordinates (row and column) of the three targets at that time step.
         action_list (List[int]): A list of integers representing the sequence of actions taken by the agent where 0 represents
         north, 1 represents east, 2 represents south, and 3 represents west.
-        grid_size (Optional[int]): An optional integer representing the size of the square grid. Defaults to 10.
     Returns:
         CheckSatResult: An enumeration indicating whether the given sequence is free of loops (sat) or not (unsat).
     """
@@ -247,26 +564,11 @@ def find_loop(
         target_positions,
         _,
         agent_direction,
-    ) = init_environment(len(action_list), grid_size)
-
-    # Add the run's data as constraints to the solver
-    for t in range(len(agent_position_list)):
-        solver.add(agent_position["row"][t] == int(agent_position_list[t][0]))
-        solver.add(agent_position["column"][t] == int(agent_position_list[t][1]))
-
-        for i in range(3):
-            solver.add(
-                target_positions[i]["row"][t] == int(target_position_list[t][i][0])
-            )
-            solver.add(
-                target_positions[i]["column"][t] == int(target_position_list[t][i][1])
-            )
-
-        solver.add(agent_direction["north"][t] == bool(action_list[t] == 0))
-        solver.add(agent_direction["east"][t] == bool(action_list[t] == 1))
-        solver.add(agent_direction["south"][t] == bool(action_list[t] == 2))
-        solver.add(agent_direction["west"][t] == bool(action_list[t] == 3))
+    ) = environment
 
+    # Add this check's constraints in a separate scope, so that they are removed again afterwards
+    solver.push()
+    constraints: List[BoolRef] = []
 
     for t in range(len(action_list) - 1):
         # To satisfy condition that agent does not do 2-step loops unless it has reached a target,
@@ -282,7 +584,7 @@ def find_loop(
         #   L_WE - agent has gone west and immediately east
         #   L_EW - agent has gone east and immediately west
         #   condition: ~(T_1 ^ T_2 ^ T_3 ^ (L_NS v L_SN v L_WE v L_EW))
-        solver.add(
+        constraints.append(
             Not(
                 And(
                     Or( # T_1 - agent has not reached first target
@@ -322,26 +624,35 @@ def find_loop(
             )
         )
 
-    return solver.check()
+    solver.add(And(*constraints, solver.ctx))
+    result = solver.check(*assumptions)
+    solver.pop()
+    return result
 
 
 def find_efficient_path(
+    environment: Environment,
+    assumptions: List[BoolRef],
     agent_position_list: List[List[int]],
     target_position_list: List[List[List[int]]],
     action_list: List[int],
-    grid_size: Optional[int] = 10,
+    picks: Optional[List[Tuple[int, int]]] = None,
 ) -> CheckSatResult:
     """
     Checks if the path of the agent took the most efficient path to a target.
 
     Args:
+        environment (Environment): The solver and variables of the environment, as returned by init_environment, with
+        the run's data added by add_run_data.
+        assumptions (List[BoolRef]): The assumptions under which the run's data holds, as returned by add_run_data.
         agent_position_list (List[List[int]]): A list of agent positions where each position is a list of two integers
         representing the coordinates (row and column) of the agent at that time step.
         target_position_list (List[List[List[int]]]): A list of target positions where each target position is a list of
         three lists of two integers representing the coordinates (row and column) of the three targets at that time step.
         action_list (List[int]): A list of integers representing the sequence of actions taken by the agent where 0 represents
         north, 1 represents east, 2 represents south, and 3 represents west.
-        grid_size (Optional[int]): An optional integer representing the size of the square grid. Defaults to 10.
+        picks (List[Tuple[int, int]], optional): The picked targets, as returned by detect_picks. Found from the
+        target_position_list if not given.
     Returns:
         CheckSatResult: An enumeration indicating whether the given sequence the shortest path (sat) or not (unsat).
     """
@@ -351,36 +662,16 @@ def find_efficient_path(
         target_positions,
         _,
         agent_direction,
-    ) = init_environment(len(action_list), grid_size)
+    ) = environment
 
-    # Add the run's data as constraints to the solver
-    for t in range(len(agent_position_list)):
-        solver.add(agent_position["row"][t] == int(agent_position_list[t][0]))
-        solver.add(agent_position["column"][t] == int(agent_position_list[t][1]))
-
-        for i in range(3):
-            solver.add(
-                target_positions[i]["row"][t] == int(target_position_list[t][i][0])
-            )
-            solver.add(
-                target_positions[i]["column"][t] == int(target_position_list[t][i][1])
-            )
-
-        solver.add(agent_direction["north"][t] == bool(action_list[t] == 0))
-        solver.add(agent_direction["east"][t] == bool(action_list[t] == 1))
-        solver.add(agent_direction["south"][t] == bool(action_list[t] == 2))
-        solver.add(agent_direction["west"][t] == bool(action_list[t] == 3))
+    # Add this check's constraints in a separate scope, so that they are removed again afterwards
+    solver.push()
+    constraints: List[BoolRef] = []
 
-    # I find the list of targets picked by the agent by checking at each time step
-    # if any of the targets' coordinates have changed
-    chosen_targets = []
-    for t in range(len(action_list) - 1):
-        for i in range(3):
-            if (
-                target_position_list[t][i][0] != target_position_list[t + 1][i][0]
-                or target_position_list[t][i][1] != target_position_list[t + 1][i][1]
-            ):
-                chosen_targets.append((i, t + 1))
+    # I find the list of targets picked by the agent (with their arrival times), unless it is given
+    chosen_targets = (
+        picks if picks is not None else detect_picks(np.asarray(target_position_list))
+    )
 
     current_target_it = 0
     current_target, arr_time = chosen_targets[current_target_it]
@@ -399,116 +690,116 @@ def find_efficient_path(
         # to move south (NOTE: important that it's NOT BELOW instead of ABOVE; this ensures that
         # if the target is directly north, south, east or west of the agent, it will only be allowed
         # to move in one correct dimension)
-        solver.add(
-            If(
-                target_positions[current_target]["row"][t] <= agent_position["row"][t],
+        constraints.append(
+            Implies(
+                ULE(
+                    target_positions[current_target]["row"][t], agent_position["row"][t]
+                ),
                 Not(agent_direction["south"][t]),
-                True,
             )
         )
         # If the currently chosen target is not above the agent, the agent is not allowed
         # to move north
-        solver.add(
-            If(
-                target_positions[current_target]["row"][t] >= agent_position["row"][t],
+        constraints.append(
+            Implies(
+                UGE(
+                    target_positions[current_target]["row"][t], agent_position["row"][t]
+                ),
                 Not(agent_direction["north"][t]),
-                True,
             )
         )
         # If the currently chosen target is not to the right of the agent, the agent is not allowed
         # to move east
-        solver.add(
-            If(
-                target_positions[current_target]["column"][t]
-                <= agent_position["column"][t],
+        constraints.append(
+            Implies(
+                ULE(
+                    target_positions[current_target]["column"][t],
+                    agent_position["column"][t],
+                ),
                 Not(agent_direction["east"][t]),
-                True,
             )
         )
         # If the currently chosen target is not to the left of the agent, the agent is not allowed
         # to move west
-        solver.add(
-            If(
-                target_positions[current_target]["column"][t]
-                >= agent_position["column"][t],
+        constraints.append(
+            Implies(
+                UGE(
+                    target_positions[current_target]["column"][t],
+                    agent_position["column"][t],
+                ),
                 Not(agent_direction["west"][t]),
-                True,
             )
         )
 
-    return solver.check()
+    solver.add(And(*constraints, solver.ctx))
+    result = solver.check(*assumptions)
+    solver.pop()
+    return result
 
 
 def closest_target(
+    environment: Environment,
+    assumptions: List[BoolRef],
     agent_position_list: List[List[int]],
     target_position_list: List[List[List[int]]],
     action_list: List[int],
-    grid_size: Optional[int] = 10,
+    picks: Optional[List[Tuple[int, int]]] = None,
 ) -> CheckSatResult:
     """
     Checks if the path of the agent was to the closest possible target
 
     Args:
+        environment (Environment): The solver and variables of the environment, as returned by init_environment, with
+        the run's data added by add_run_data.
+        assumptions (List[BoolRef]): The assumptions under which the run's data holds, as returned by add_run_data.
         agent_position_list (List[List[int]]): A list of agent positions where each position is a list of two integers
         representing the coordinates (row and column) of the agent at that time step.
         target_position_list (List[List[List[int]]]): A list of target positions where each target position is a list of
         three lists of two integers representing the coordinates (row and column) of the three targets at that time step.
         action_list (List[int]): A list of integers representing the sequence of actions taken by the agent where 0 represents
         north, 1 represents east, 2 represents south, and 3 represents west.
-        grid_size (Optional[int]): An optional integer representing the size of the square grid. Defaults to 10.
+        picks (List[Tuple[int, int]], optional): The picked targets, as returned by detect_picks. Found from the
+        target_position_list if not given.
     Returns:
         CheckSatResult: An enumeration indicating whether the given sequence to the closest target (sat) or not (unsat).
     """
-    # TODO: Implement this function as specified. Note that you may not need all arguments made available to you.
     (
         solver,
         agent_position,
         target_positions,
         targets_distance,
         agent_direction,
-    ) = init_environment(len(action_list), grid_size)
-    for t in range(len(agent_position_list)):
-        solver.add(agent_position["row"][t] == int(agent_position_list[t][0]))
-        solver.add(agent_position["column"][t] == int(agent_position_list[t][1]))
+    ) = environment
 
-        for i in range(3):
-            solver.add(
-                target_positions[i]["row"][t] == int(target_position_list[t][i][0])
-            )
-            solver.add(
-                target_positions[i]["column"][t] == int(target_position_list[t][i][1])
-            )
+    # I find the list of targets picked by the agent, unless it is given, and the times of choosing them
+    if picks is None:
+        picks = detect_picks(np.asarray(target_position_list))
+    chosen_targets, choosing_times, closer = _closer_targets(
+        np.asarray(agent_position_list), np.asarray(target_position_list), picks
+    )
 
-        solver.add(agent_direction["north"][t] == bool(action_list[t] == 0))
-        solver.add(agent_direction["east"][t] == bool(action_list[t] == 1))
-        solver.add(agent_direction["south"][t] == bool(action_list[t] == 2))
-        solver.add(agent_direction["west"][t] == bool(action_list[t] == 3))
+    # The run's data is fixed by the assumptions, so the comparisons of the distances are already known. Only the ones
+    # where another target was closer need to be added as constraints (callers that want to skip the solver when there
+    # are none can use picks_closest, after checking the run's data)
 
-    # I find the list of targets picked by the agent by checking at each time step
-    # if any of the targets' coordinates have changed. I also save times of choosing the next target
-    chosen_targets = []
-    choosing_times = [0]
-    for t in range(len(action_list) - 1):
-        for i in range(3):
-            if (
-                target_position_list[t][i][0] != target_position_list[t + 1][i][0]
-                or target_position_list[t][i][1] != target_position_list[t + 1][i][1]
-            ):
-                chosen_targets.append(i)
-                choosing_times.append(t + 1)
-    choosing_times.pop()
+    # Add this check's constraints in a separate scope, so that they are removed again afterwards
+    solver.push()
+    constraints: List[BoolRef] = []
 
     # At each time step when a new target is chosen, I check that the chosen target is the closest
-    # (or one of the closest) to the agent at the time of choosing
-    for i in range(len(chosen_targets)):
-        choosing_time = choosing_times[i]
-        chosen_target = chosen_targets[i]
-        for target in range(3):
-            if target == chosen_target:
-                continue
-            solver.add(
-                targets_distance[chosen_target]["row"][choosing_time]
-                + targets_distance[chosen_target]["column"][choosing_time] <=
-                targets_distance[target]["row"][choosing_time] + targets_distance[target]["column"][choosing_time]
-            )
-    return solver.check()
+    # (or one of the closest) to the agent at the time of choosing, for the targets that were closer
+    for i, target in zip(*np.nonzero(closer)):
+        choosing_time = int(choosing_times[i])
+        chosen_target = int(chosen_targets[i])
+        target = int(target)
+        # The distances are signed bit-vectors, for which <= is the signed comparison
+        constraints.append(
+            _distance(environment, chosen_target, "row", choosing_time)
+            + _distance(environment, chosen_target, "column", choosing_time)
+            <= _distance(environment, target, "row", choosing_time)
+            + _distance(environment, target, "column", choosing_time)
+        )
+    solver.add(And(*constraints, solver.ctx))
+    result = solver.check(*assumptions)
+    solver.pop()
+    return result
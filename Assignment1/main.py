@@ -1,10 +1,7 @@
-import os
-
-# Ignore tensorflow warnings
-os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 import argparse
 import time
-from typing import List
+
+import numpy as np
 from z3 import unsat, sat
 
 from checker import *
@@ -42,53 +39,140 @@ def arg_parser() -> argparse.Namespace:
         default=0.1,
         help="Time in seconds to wait between printing timesteps.",
     )
+    parser.add_argument(
+        "--no-render",
+        action="store_true",
+        help="Do not print the map (nor wait) while running, e.g. to time the simulation and the checks.",
+    )
+    parser.add_argument(
+        "--render-every",
+        type=int,
+        default=1,
+        help="Print the map (and wait) only every this many timesteps.",
+    )
+    parser.add_argument(
+        "-q",
+        "--quantize",
+        action="store_true",
+        help="Quantize the DQN weights to int8.",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="Path of a cache of the checks' results, so that verifying the same run again skips the solver.",
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.render_every < 1:
+        parser.error(
+            f"argument --render-every: must be at least 1, but is {args.render_every}"
+        )
+
+    return args
 
 
 args = arg_parser()
-agent = Agent(weights=args.weights)
-agent_position_list: List[List[int]] = []
-target_position_list: List[List[List[int]]] = []
-action_list: List[int] = []
+agent = Agent(weights=args.weights, quantize=args.quantize, render=not args.no_render)
+
+# Buffers for the run's data, which are doubled in size whenever they are full. The positions are stored in the
+# smallest integer type that holds every position on the grid
+capacity = 32 * (args.num_collect + 1)
+position_dtype = np.min_scalar_type(agent.grid_size - 1)
+agent_positions = np.empty((capacity, 2), dtype=position_dtype)
+target_positions = np.empty((capacity, 3, 2), dtype=position_dtype)
+actions = np.empty(capacity, dtype=np.int8)
+timesteps = 0
 
 # Print the initial map
-agent.print_map()
+if not args.no_render:
+    agent.print_map()
 
 # Run the game until the agent collects all the required number of targets
 while agent.total_collected <= args.num_collect:
-    # Clear the previous lines
-    agent.clear_lines(13)
-
     # Get the agent's current state
     obs = agent.get_state()
 
     # Get the agent's action for the current state
     agent_action = agent.get_action(obs)
 
-    # Append current state data to the list for posterity
-    agent_position_list.append(agent.agent_position.copy())
-    target_position_list.append(agent.target_positions.copy())
-    action_list.append(agent_action)
+    # Store current state data in the buffers for posterity
+    if timesteps == len(actions):
+        agent_positions, target_positions, actions = [
+            np.concatenate([buffer, np.empty_like(buffer)])
+            for buffer in [agent_positions, target_positions, actions]
+        ]
+    agent_positions[timesteps] = agent.agent_position
+    target_positions[timesteps] = agent.target_positions
+    actions[timesteps] = agent_action
+    timesteps += 1
 
     # Move the agent and get the reward (reward ignored for now)
     _ = agent.move(agent_action)
 
-    # Print the map
-    agent.print_map()
-    print("collected: " + str(agent.total_collected))
-    time.sleep(args.sleep)
+    # Print the map over the previous one, if rendering this timestep
+    if not args.no_render and timesteps % args.render_every == 0:
+        agent.clear_lines(13)
+        agent.print_map()
+        print("collected: " + str(agent.total_collected))
+        time.sleep(args.sleep)
 
 if args.perform_check:
     print("\nVerifying the agent's run...")
 
-    if check_run(agent_position_list, target_position_list, action_list) == unsat:
+    # The run's data is the filled part of the buffers, all the checks share it
+    agent_positions = agent_positions[:timesteps]
+    target_positions = target_positions[:timesteps]
+    actions = actions[:timesteps]
+
+    # Find the targets picked by the agent once, for the checks that need them
+    picks = detect_picks(target_positions)
+
+    # The solver is only asked about the loops and the closest targets if the run's data does not already decide them:
+    # a run without any step straight back cannot contain a loop, and the picked targets can be compared directly
+    checks = {"run": (check_run,), "efficiency": (find_efficient_path, picks)}
+    if has_step_back(actions):
+        checks["loop"] = (find_loop,)
+    if not picks_closest(agent_positions, target_positions, picks):
+        checks["closest"] = (closest_target, picks)
+
+    # Neither is it asked about the checks whose results for the same run have been cached
+    results = {}
+    if args.cache is not None:
+        key = run_key(agent_positions, target_positions, actions, agent.grid_size)
+        results = load_results(args.cache, key)
+        checks = {name: check for name, check in checks.items() if name not in results}
+
+    # Build the environment and add the run's data once (if any check is left for the solver), the checks share them
+    if checks:
+        environment = init_environment(len(actions))
+        assumptions = add_run_data(
+            environment, agent_positions, target_positions, actions
+        )
+        for name, (check, *extra_args) in checks.items():
+            results[name] = check(
+                environment,
+                assumptions,
+                agent_positions,
+                target_positions,
+                actions,
+                *extra_args,
+            )
+
+    if args.cache is not None and checks:
+        save_results(args.cache, key, results)
+
+    run_failed = results["run"] == unsat
+    if run_failed:
         print("Agent's run failed the initial check! Check the simulation for bugs.")
     else:
         print("Agent's run passed the initial check!")
 
+    # A failed run fails every check, including the ones decided without the solver
+    decided = unsat if run_failed else sat
+
     print("\nPerforming loop-check on the agent's run...")
-    res = find_loop(agent_position_list, target_position_list, action_list)
+    res = results.get("loop", decided)
     if res == unsat:
         print("Agent's run contains a loop.")
     elif res == sat:
@@ -98,7 +182,7 @@ if args.perform_check:
               f"Please implement the 'find_loop' function as specified.")
         
     
-    res = find_efficient_path(agent_position_list, target_position_list, action_list)
+    res = results["efficiency"]
     print("\nPerforming efficiency check on the agent's run...")
     if res == unsat:
         print("Agent did not take the shortest path. You need to provide a counterexample.")
@@ -109,7 +193,7 @@ if args.perform_check:
               f"Please implement the 'find_efficient_path' function as specified.")
 
 
-    res = closest_target(agent_position_list, target_position_list, action_list)
+    res = results.get("closest", decided)
     print("\nPerforming closest target check on the agent's run...")
     if res == unsat:
         print("Agent did not go for the closest target. You need to provide a counterexample.")